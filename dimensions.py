@@ -1,13 +1,39 @@
 import dimcli
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import hashlib
+import itertools
+import json
 import os
+import time
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
 
 # Load environment variables from .env
 load_dotenv()
 
+# Directory where raw query responses are cached
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dimensions')
+
+# Fields of the author records returned by the Dimensions API
+AUTHOR_COLUMNS = ['first_name', 'last_name', 'initials', 'researcher_id', 'orcid', 'corresponding',
+                  'current_organization_id', 'raw_affiliation', 'affiliations']
+
+# Minimum number of author rows for the counts to be computed in parallel threads
+PARALLEL_COUNT_THRESHOLD = 100_000
+
+# Logged-in DSL clients, shared by all the instances with the same (endpoint, api_key)
+_DSL_CLIENTS = {}
+
 class DimensionsQuery:
+    __slots__ = ('endpoint', 'api_key', 'dsl', 'topic', 'where', 'search', 'return_cols',
+                 'query', 'results', '_results_df', '_authors_df',
+                 '_journal_counts', '_author_counts', '_country_counts', '_institution_counts')
+
+    # Template of the DSL query built by update_query
+    _QUERY_TMPL = 'search {search} for "{topic}"{where_clause} return {search}{cols_clause}'
+
     def __init__(self, topic='machine learning and healthcare', where=None, search = 'publications', return_cols=None, endpoint="https://app.dimensions.ai"):
         """
         Initializes a DimensionsQuery instance.
@@ -18,15 +44,12 @@ class DimensionsQuery:
         - search (str): The type of search (e.g., 'publications').
         - return_cols (srt): The columns to return in the query seperated by + (e.g., 'id+title+authors+pages+type+volume+year+journal.id+journal.title+issue+times_cited')
         - endpoint (str): The API endpoint for the Dimensions API.
-
-        Raises:
-        - ValueError: If API key is not found in the environment variables.
         """
         
-        # Login
+        # Login is deferred until the query is first run
         self.endpoint = endpoint
         self.api_key = os.getenv("DIMENSIONS_API_KEY")
-        self.dsl = self.validate_key()
+        self.dsl = None
 
         # Query attributes
         self.topic = topic
@@ -35,36 +58,66 @@ class DimensionsQuery:
         self.return_cols = return_cols
         self.update_query()
 
+        # Query results
+        self.results = None
+        self._results_df = None
+        self._authors_df = None
+        self.clear_counts()
+
     def validate_key(self):
         """
         Validates and logs in using the API key.
 
+        The login is done only once per endpoint and API key, and the resulting DSL is reused.
+
         Returns:
         - dimcli.Dsl: An instance of the Dimensions DSL.
+
+        Raises:
+        - ValueError: If API key is not found in the environment variables.
         """
         if self.api_key is None:
             raise ValueError("API key not found. Make sure to set DIMENSIONS_API_KEY in your .env file.")
 
-        dimcli.login(key=self.api_key, endpoint=self.endpoint)
-        dsl = dimcli.Dsl()
-        return dsl
+        key = (self.endpoint, self.api_key)
+        if key not in _DSL_CLIENTS:
+            dimcli.login(key=self.api_key, endpoint=self.endpoint)
+            _DSL_CLIENTS[key] = dimcli.Dsl()
+        return _DSL_CLIENTS[key]
 
     def update_query(self):
         """
         Updates the query based on the current topic, where clause, and search type.
         """
     
-        if self.return_cols:
-            _return = f'return {self.search}[{self.return_cols}]'
-        else:
-            _return = f'return {self.search}'
-
-        if self.where:
-            self.query = f'search {self.search} for "{self.topic}" where {self.where} {_return}'
-        else:
-            self.query = f'search {self.search} for "{self.topic}" {_return}'
+        self.query = self._QUERY_TMPL.format(
+            search=self.search,
+            topic=self.topic,
+            where_clause=f' where {self.where}' if self.where else '',
+            cols_clause=f'[{self.return_cols}]' if self.return_cols else '',
+        )
     
             
+    def update(self, topic=None, where=None, search=None, return_cols=None):
+        """
+        Updates several query attributes at once and rebuilds the query a single time.
+
+        Parameters:
+        - topic (str): The new topic for the query.
+        - where (str): The new where clause for the query.
+        - search (str): The new search type for the query.
+        - return_cols (str): The new columns to return, separated by +.
+        """
+        if topic is not None:
+            self.topic = topic
+        if where is not None:
+            self.where = where
+        if search is not None:
+            self.search = search
+        if return_cols is not None:
+            self.return_cols = return_cols
+        self.update_query()
+
     def update_topic(self, topic):
         """
         Updates the query topic and re-runs the query.
@@ -95,28 +148,189 @@ class DimensionsQuery:
         self.search = search
         self.update_query()
 
-    def run_query(self, df=True):
+    def cache_path(self, iterative):
+        """
+        Returns the path of the cache file for the current endpoint, query and paging mode.
+
+        Parameters:
+        - iterative (bool): Whether the response pages through all the results.
+
+        Returns:
+        - str: The path of the JSON cache file.
+        """
+        key = hashlib.sha1(f"{self.endpoint}|{self.query}|{iterative}".encode()).hexdigest()
+        return os.path.join(CACHE_DIR, f'{key}.json')
+
+    def load_cached_response(self, iterative):
+        """
+        Loads the cached response for the current query and paging mode, if any.
+
+        Cached responses never expire; on a cache hit, the date the response was saved is printed.
+
+        Parameters:
+        - iterative (bool): Whether the response pages through all the results.
+
+        Returns:
+        - dimcli.DslDataset or None: The cached response, or None on a cache miss.
+        """
+        path = self.cache_path(iterative)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        # Ignore files that are valid JSON but were not written by save_cached_response
+        if not isinstance(entry, dict) or not isinstance(entry.get('data'), dict):
+            return None
+
+        # Make it clear the results are not live, since cached entries never expire
+        meta = entry.get('meta')
+        timestamp = meta.get('timestamp') if isinstance(meta, dict) else None
+        if isinstance(timestamp, (int, float)):
+            saved = time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+        else:
+            saved = 'an unknown date'
+        print(f"Loaded cached results saved on {saved}. Use run_query(use_cache=False) to refresh them.")
+
+        return dimcli.DslDataset(entry['data'])
+
+    def save_cached_response(self, response, iterative):
+        """
+        Stores the raw JSON of a response on disk, along with some metadata.
+
+        Caching is best-effort: if the response cannot be written, a message is printed and the
+        error is not raised.
+
+        Parameters:
+        - response (dimcli.DslDataset): The query response to cache.
+        - iterative (bool): Whether the response pages through all the results.
+        """
+        entry = {
+            'meta': {
+                'endpoint': self.endpoint,
+                'query': self.query,
+                'iterative': iterative,
+                'dimcli_version': getattr(dimcli, 'VERSION', None),
+                'timestamp': time.time(),
+            },
+            'data': response.json,
+        }
+
+        path = self.cache_path(iterative)
+        tmp_path = f'{path}.tmp'
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Could not cache the response in {CACHE_DIR}: {e}")
+        finally:
+            try:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def clear_cache(self):
+        """
+        Removes all the cached query responses.
+        """
+        if not os.path.isdir(CACHE_DIR):
+            return
+
+        for name in os.listdir(CACHE_DIR):
+            if name.endswith(('.json', '.json.tmp')):
+                os.remove(os.path.join(CACHE_DIR, name))
+
+    def build_dataframes(self, response):
+        """
+        Flattens the raw records of a response into the results and authors DataFrames.
+
+        The results DataFrame has one row per record, and the authors DataFrame has one row per
+        author of each record, with the country and name of their first affiliation as columns.
+
+        Parameters:
+        - response (dimcli.DslDataset): The query response.
+        """
+        records = response.json.get(self.search, [])
+        self._results_df = pd.json_normalize(records)
+
+        # Repeated strings are stored as categories, which are cheaper to hold and to count
+        if 'journal.title' in self._results_df:
+            self._results_df['journal.title'] = self._results_df['journal.title'].astype('category')
+
+        with_authors = [record for record in records if record.get('authors')]
+        authors = itertools.chain.from_iterable(record['authors'] for record in with_authors)
+        authors_df = pd.DataFrame.from_records(authors, columns=AUTHOR_COLUMNS)
+        authors_df['publication.id'] = [record.get('id') for record in with_authors for _ in record['authors']]
+
+        first_affiliations = [a[0] if isinstance(a, list) and a else {} for a in authors_df['affiliations'].to_numpy()]
+        authors_df['affiliation.country'] = pd.Categorical([a.get('country') for a in first_affiliations])
+        authors_df['affiliation.name'] = pd.Categorical([a.get('name') for a in first_affiliations])
+        self._authors_df = authors_df
+
+    def clear_counts(self):
+        """
+        Clears the top 10 counts computed by analyze_results for the previous results.
+        """
+        self._journal_counts = None
+        self._author_counts = None
+        self._country_counts = None
+        self._institution_counts = None
+
+    def run_query(self, df=True, use_cache=True, iterative=False, copy=False):
         """
         Runs the Dimensions query.
 
         Parameters:
         - df (bool): If True, returns the results as a DataFrame.
+        - use_cache (bool): If True, reuses a response cached on disk for the same endpoint, query
+          and paging mode.
+        - iterative (bool): If True, pages through all the results with dimcli's query_iterative
+          instead of returning only the first page of a single query. This can take minutes for
+          broad topics, and the query must not contain limit or skip.
+        - copy (bool): If True, returns a deep copy of the DataFrame that is safe to modify.
 
         Returns:
-        - dimcli.DslDataset or pd.DataFrame: The query response.
+        - dimcli.DslDataset or pd.DataFrame: The query response. Unless copy is True, the DataFrame
+          is a shallow copy of the one cached on the instance, so it should be treated as read-only.
+
+        Raises:
+        - ValueError: If the query is not set, or the API key is not found when logging in.
         """
         if self.query is None:
             raise ValueError("Query not specified. Use update_query method to set the query.")
 
-        response = self.dsl.query(self.query)
+        response = self.load_cached_response(iterative) if use_cache else None
+        if response is None:
+            if self.dsl is None:
+                self.dsl = self.validate_key()
+            if iterative:
+                response = self.dsl.query_iterative(self.query)
+            else:
+                response = self.dsl.query(self.query)
+            if use_cache and not response.errors:
+                self.save_cached_response(response, iterative)
+
         print(f"Done! {response.stats['total_count']} results available")
         print("Errors: ", response.errors)
 
+        self._results_df = None
+        self._authors_df = None
+        self.clear_counts()
         if df:
-            response = response.as_dataframe()
+            # Convert once and reuse the DataFrames in analyze_results
+            self.build_dataframes(response)
+            self.results = self._results_df
+            return self._results_df.copy(deep=copy)
 
         self.results = response
-        return response.copy()
+        return response
 
 
     def analyze_results(self):
@@ -130,120 +344,146 @@ class DimensionsQuery:
         if self.results is None:
             raise ValueError("No results to analyze. Run the query first.")
 
-        # Convert results to DataFrame
-        if isinstance(self.results, pd.DataFrame):
-            df = self.results.copy()
-        else:
-            df = self.results.as_dataframe().copy()
+        # Convert results to DataFrames only if run_query did not already do it
+        if self._results_df is None:
+            self.build_dataframes(self.results)
+        df = self._results_df
+        authors_df = self._authors_df
+
+        # Counts are computed once per query run and reused on later calls
+        if self._journal_counts is None:
+            columns = [df['journal.title'], authors_df['researcher_id'],
+                       authors_df['affiliation.country'], authors_df['affiliation.name']]
+
+            # The counts are independent, so large results are counted in parallel threads
+            if len(authors_df) >= PARALLEL_COUNT_THRESHOLD:
+                with ThreadPoolExecutor(max_workers=len(columns)) as executor:
+                    counts = list(executor.map(self.count_top, columns))
+            else:
+                counts = [self.count_top(column) for column in columns]
+
+            self._journal_counts, self._author_counts, self._country_counts, self._institution_counts = counts
+
+        # All the plots share a single figure
+        fig, ((ax_journals, ax_authors), (ax_countries, ax_institutions)) = plt.subplots(2, 2, figsize=(14, 10))
 
         # Most Common Journal
-        self.plot_most_common_journal(df)
+        self.plot_most_common_journal(self._journal_counts, ax_journals)
 
         # Publications per Author
-        self.plot_publications_per_author(df)
+        self.plot_publications_per_author(self._author_counts, ax_authors)
 
         # Most Common Country
-        self.plot_most_common_country(df)
+        self.plot_most_common_country(self._country_counts, ax_countries)
 
         # Most Common Institutions
-        self.plot_most_common_institutions(df)
+        self.plot_most_common_institutions(self._institution_counts, ax_institutions)
+
+        plt.tight_layout()
+        plt.show()
+        plt.close(fig)
+
+    def count_top(self, values, n=10):
+        """
+        Counts the most common values of a column, ignoring missing values.
+
+        Parameters:
+        - values (pd.Series): The column to count.
+        - n (int): The number of most common values to keep.
+
+        Returns:
+        - pd.Series: The counts of the n most common values, in descending order.
+        """
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            return values.value_counts(sort=False).nlargest(n)
+
+        # Tally the integer codes of the categories directly, missing values have code -1
+        codes = values.cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(values.cat.categories))
+
+        # Partially select the n largest counts, then sort only those
+        n = min(n, np.count_nonzero(counts))
+        top = np.argpartition(-counts, n - 1)[:n] if n else np.array([], dtype=int)
+        top = top[np.argsort(-counts[top], kind='stable')]
+        return pd.Series(counts[top], index=values.cat.categories[top], name='count')
   
-    def plot_most_common_journal(self, df):
+    def plot_most_common_journal(self, top_journals, ax):
         """
         Plots and displays the top 10 most common journals in the query results.
 
         Parameters:
-        - df (pd.DataFrame): The DataFrame containing the query results.
+        - top_journals (pd.Series): The number of publications of the top 10 journals.
+        - ax (matplotlib.axes.Axes): The axes to draw the plot on.
         """
 
         print('#'*40, f' Most common Journal ' , '#'*40)
-        journal_counts = df['journal.title'].value_counts()
-        top_journals = journal_counts.head(10)
 
         # Plot
-        top_journals.plot(kind='bar', color='skyblue')
-        plt.title(f'Top 10 Journals in {self.topic} Publications')
-        plt.xlabel('Journal')
-        plt.ylabel('Number of Publications')
-        plt.show()
+        top_journals.plot(kind='bar', color='skyblue', ax=ax)
+        ax.set_title(f'Top 10 Journals in {self.topic} Publications')
+        ax.set_xlabel('Journal')
+        ax.set_ylabel('Number of Publications')
 
         # Display frequency in a table
-        top_journals_table = pd.DataFrame(top_journals.reset_index())
-        top_journals_table.columns = ['Journal', 'Number of Publications']
-        print(top_journals_table)
+        print(top_journals.rename_axis('Journal').to_frame('Number of Publications').to_string())
 
 
-    def plot_publications_per_author(self, df):
+    def plot_publications_per_author(self, top_authors, ax):
         """
         Plots and displays the top 10 authors with the highest number of publications.
 
         Parameters:
-        - df (pd.DataFrame): The DataFrame containing the query results.
+        - top_authors (pd.Series): The number of publications of the top 10 authors.
+        - ax (matplotlib.axes.Axes): The axes to draw the plot on.
         """
         print('#'*40, f' Publications Per Author ' , '#'*40)
-        authors_df = pd.DataFrame([author for authors in df['authors'] for author in authors])
-        author_counts = authors_df['researcher_id'].value_counts()
-        top_authors = author_counts.head(10)
 
         # Plot
-        top_authors.plot(kind='bar', color='salmon')
-        plt.title(f'Top 10 Authors in {self.topic} Publications')
-        plt.xlabel('Researcher ID')
-        plt.ylabel('Number of Publications')
-        plt.show()
+        top_authors.plot(kind='bar', color='salmon', ax=ax)
+        ax.set_title(f'Top 10 Authors in {self.topic} Publications')
+        ax.set_xlabel('Researcher ID')
+        ax.set_ylabel('Number of Publications')
 
         # Display frequency in a table
-        top_authors_table = pd.DataFrame(top_authors.reset_index())
-        top_authors_table.columns = ['Researcher ID', 'Number of Publications']
-        print(top_authors_table)
+        print(top_authors.rename_axis('Researcher ID').to_frame('Number of Publications').to_string())
 
 
-    def plot_most_common_country(self, df):
+    def plot_most_common_country(self, top_countries, ax):
         """
         Plots and displays the top 10 countries with the highest number of publications.
 
         Parameters:
-        - df (pd.DataFrame): The DataFrame containing the query results.
+        - top_countries (pd.Series): The number of publications of the top 10 countries.
+        - ax (matplotlib.axes.Axes): The axes to draw the plot on.
         """
         print('#'*40, f' Publications Per Country ' , '#'*40)
-        authors_df = pd.DataFrame([author for authors in df['authors'] for author in authors])
-        country_counts = authors_df['affiliations'].apply(lambda x: x[0]['country'] if x else None).value_counts()
-        top_countries = country_counts.head(10)
 
         # Plot
-        top_countries.plot(kind='bar', color='lightgreen')
-        plt.title(f'Top 10 Countries in {self.topic} Publications')
-        plt.xlabel('Country')
-        plt.ylabel('Number of Publications')
-        plt.show()
+        top_countries.plot(kind='bar', color='lightgreen', ax=ax)
+        ax.set_title(f'Top 10 Countries in {self.topic} Publications')
+        ax.set_xlabel('Country')
+        ax.set_ylabel('Number of Publications')
 
         # Display frequency in a table
-        top_countries_table = pd.DataFrame(top_countries.reset_index())
-        top_countries_table.columns = ['Country', 'Number of Publications']
-        print(top_countries_table)
+        print(top_countries.rename_axis('Country').to_frame('Number of Publications').to_string())
 
 
-    def plot_most_common_institutions(self, df):
+    def plot_most_common_institutions(self, top_institutions, ax):
         """
         Plots and displays the top 10 institutions with the highest number of publications.
 
         Parameters:
-        - df (pd.DataFrame): The DataFrame containing the query results.
+        - top_institutions (pd.Series): The number of publications of the top 10 institutions.
+        - ax (matplotlib.axes.Axes): The axes to draw the plot on.
         """
         print('#'*40, f' Publications Per Institutions ' , '#'*40)
-        authors_df = pd.DataFrame([author for authors in df['authors'] for author in authors])
-        institution_counts = authors_df['affiliations'].apply(lambda x: x[0]['name'] if x else None).value_counts()
-        top_institutions = institution_counts.head(10)
 
         # Plot
-        top_institutions.plot(kind='bar', color='lightcoral')
-        plt.title(f'Top 10 Institutions in {self.topic} Publications')
-        plt.xlabel('Institution')
-        plt.ylabel('Number of Publications')
-        plt.show()
+        top_institutions.plot(kind='bar', color='lightcoral', ax=ax)
+        ax.set_title(f'Top 10 Institutions in {self.topic} Publications')
+        ax.set_xlabel('Institution')
+        ax.set_ylabel('Number of Publications')
 
         # Display frequency in a table
-        top_institutions_table = pd.DataFrame(top_institutions.reset_index())
-        top_institutions_table.columns = ['Institution', 'Number of Publications']
-        print(top_institutions_table)
+        print(top_institutions.rename_axis('Institution').to_frame('Number of Publications').to_string())
 